@@ -21,5 +21,5 @@ export async function generateImage(base, { prompt }) {
   if (!r.ok) throw new Error(`SD HTTP ${r.status}`);
   const j = await r.json();
   if (!j.image_base64) throw new Error('Kein Bild erhalten');
-  return { url: `data:image/png;base64,${j.image_base64}` };
+  return { url: `data:image/${j.format || 'png'};base64,${j.image_base64}` };
 }
\ No newline at end of file
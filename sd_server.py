@@ -7,8 +7,11 @@ import time
 import asyncio
 import io
 import base64
-from typing import Optional, Tuple
+import inspect
+from typing import List, Literal, Optional, Tuple
 from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
 
 from fastapi import FastAPI, HTTPException
 from fastapi.middleware.cors import CORSMiddleware
@@ -21,11 +24,19 @@ from diffusers import (
     StableDiffusionXLPipeline,
     StableDiffusionXLImg2ImgPipeline,
     DPMSolverMultistepScheduler,
+    AutoencoderKL,
 )
 
 # ----- Model locations -----
 SDXL_DIR = os.getenv("SDXL_DIR", r"C:\LLM\stable-diffusion-xl-base-1.0")
 SDXL_REFINER_DIR = os.getenv("SDXL_REFINER_DIR", r"C:\LLM\stable-diffusion-xl-refiner-1.0")
+# Optional bitsandbytes quantization of the BASE UNet: "nf4" or "int8" (CUDA only)
+SD_QUANT = os.getenv("SD_QUANT", "").strip().lower()
+# Keep the REFINER in CPU RAM and stream each component to the GPU only while it runs
+SD_OFFLOAD = os.getenv("SD_OFFLOAD", "0") == "1"
+# Opt-in fp16-safe VAE (SDXL's stock VAE overflows in fp16); hub id or local dir
+SDXL_VAE_FP16_FIX = os.getenv("SDXL_VAE_FP16_FIX", "0") == "1"
+SDXL_VAE_FP16_FIX_DIR = os.getenv("SDXL_VAE_FP16_FIX_DIR", "madebyollin/sdxl-vae-fp16-fix")
 
 # ----- Limits / Defaults -----
 MAX_W = 1024
@@ -33,9 +44,19 @@ MAX_H = 1024
 MAX_STEPS = 60
 DEFAULT_STEPS = 60
 DEFAULT_GUIDANCE = 9.5        # strong adherence by default
+MAX_QUEUE = int(os.getenv("SD_MAX_QUEUE", "8"))  # pending /txt2img requests before answering 429
+MAX_BATCH = int(os.getenv("SD_MAX_BATCH", "4"))  # compatible queued requests merged into one UNet batch
 
 # Toggle compile via env var (off by default to avoid Triton requirement on fresh installs)
 ENABLE_TORCH_COMPILE = os.getenv("SD_TORCH_COMPILE", "0") == "1"
+# Run a few tiny generations at startup so compile/autotune cost isn't paid by the first request
+ENABLE_WARMUP = os.getenv("SD_WARMUP", "1") == "1"
+# Common SDXL shapes to pre-warm (cuDNN benchmark picks conv algos per input shape); "WxH,WxH,..."
+WARMUP_SHAPES = os.getenv("SD_WARMUP_SHAPES", "1024x1024,1024x768,768x1024,832x1024")
+# torch.compile mode; e.g. "max-autotune-no-cudagraphs" if CUDA graphs misbehave
+SD_COMPILE_MODE = os.getenv("SD_COMPILE_MODE", "reduce-overhead")
+# Inductor/Triton artifacts persist here so restarts skip recompiling & re-autotuning
+SD_CACHE_DIR = os.getenv("SD_CACHE_DIR", r"C:\LLM\cache")
 
 app = FastAPI(title="Local SDXL Server (40-step detailed)")
 
@@ -57,6 +78,13 @@ _current_device = "cpu"
 _current_dtype = "float32"
 _has_refiner = False
 
+# GPU work is serialized: one request at a time, always on the same worker thread
+# (CUDA graphs from torch.compile "reduce-overhead" are recorded per thread).
+_gpu_sem = asyncio.Semaphore(1)
+_gpu_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="sdxl-gpu")
+_job_queue: "asyncio.Queue[Tuple[Txt2ImgReq, asyncio.Future]]" = asyncio.Queue()
+_pending = 0
+
 
 def _check_layout(path: str):
     must = [
@@ -87,20 +115,95 @@ def _apply_good_scheduler(p):
         print("[SDXL] Scheduler swap skipped:", e)
 
 
+_VAE_TILE_MIN = 1024  # px; stock SDXL VAE sample_size
+
+
+def _apply_vae_opts(p, device: str):
+    """Optionally swap in the fp16-fix VAE; enable slicing (per-image decode of batched requests)
+    and tiling for resolutions above SDXL's native 1024 (see _VAE_TILE_MIN)."""
+    if SDXL_VAE_FP16_FIX and device == "cuda":
+        try:
+            p.vae = AutoencoderKL.from_pretrained(SDXL_VAE_FP16_FIX_DIR, torch_dtype=torch.float16).to(device)
+            print(f"[SDXL] Using fp16-fix VAE from: {SDXL_VAE_FP16_FIX_DIR}")
+        except Exception as e:
+            print("[SDXL] fp16-fix VAE load skipped (keeping stock VAE):", e)
+    try:
+        p.vae.enable_tiling()
+        p.vae.enable_slicing()
+        # AutoencoderKL tiles above its config sample_size, which the fp16-fix VAE sets lower than
+        # the stock 1024. Pin the threshold so every size /txt2img serves decodes in one pass
+        # (no blended tile seams / extra overlap work); tiling only kicks in if limits go >1024.
+        if hasattr(p.vae, "tile_sample_min_size"):
+            p.vae.tile_sample_min_size = _VAE_TILE_MIN
+            p.vae.tile_latent_min_size = _VAE_TILE_MIN // p.vae_scale_factor
+    except Exception as e:
+        print("[SDXL] VAE tiling/slicing skipped:", e)
+
+
+def _apply_channels_last(p, device: str):
+    """NHWC layout lets cuDNN pick its faster conv kernels for the UNet/VAE stacks."""
+    if device != "cuda":
+        return
+    for name in ("unet", "vae"):
+        module = getattr(p, name)
+        if getattr(module, "is_quantized", False):
+            continue  # bnb models refuse .to(); quantized layers don't use cuDNN convs anyway
+        try:
+            module.to(memory_format=torch.channels_last)
+        except Exception as e:
+            print(f"[SDXL] channels_last skipped for {name}:", e)
+
+
+def _load_quantized_unet(model_dir: str, dtype: torch.dtype):
+    """UNet quantized per SD_QUANT via bitsandbytes, or None (unset, unknown mode, or load failure)."""
+    if SD_QUANT not in ("nf4", "int8"):
+        if SD_QUANT:
+            print(f"[SDXL] Unknown SD_QUANT={SD_QUANT!r} (expected nf4/int8); using {dtype} UNet.")
+        return None
+    try:
+        from diffusers import BitsAndBytesConfig, UNet2DConditionModel
+
+        if SD_QUANT == "nf4":
+            qcfg = BitsAndBytesConfig(
+                load_in_4bit=True,
+                bnb_4bit_quant_type="nf4",
+                bnb_4bit_compute_dtype=torch.bfloat16,
+            )
+        else:
+            qcfg = BitsAndBytesConfig(load_in_8bit=True)
+        unet = UNet2DConditionModel.from_pretrained(
+            model_dir,
+            subfolder="unet",
+            quantization_config=qcfg,
+            torch_dtype=dtype,
+            use_safetensors=True,
+            variant="fp16",
+        )
+        print(f"[SDXL] BASE UNet quantized: {SD_QUANT}")
+        return unet
+    except Exception as e:
+        print(f"[SDXL] UNet quantization ({SD_QUANT}) skipped:", e)
+        return None
+
+
 def _build_pipeline_base(model_dir: str, device: str, dtype: torch.dtype) -> StableDiffusionXLPipeline:
     print(f"[SDXL] Building BASE pipeline: device={device}, dtype={dtype}")
+    extra = {}
+    if device == "cuda":
+        unet = _load_quantized_unet(model_dir, dtype)
+        if unet is not None:
+            extra["unet"] = unet
     p = StableDiffusionXLPipeline.from_pretrained(
         model_dir,
         torch_dtype=dtype,
         use_safetensors=True,
         variant="fp16",  # many repos tag reduced precision as "fp16"; fine to run in bf16
+        **extra,
     ).to(device)
+    _apply_vae_opts(p, device)
+    _apply_channels_last(p, device)
 
-    # Prefer PyTorch SDPA over legacy attention slicing/xFormers
-    try:
-        p.enable_xformers_memory_efficient_attention(False)
-    except Exception:
-        pass
+    # Attention: diffusers defaults to PyTorch SDPA (AttnProcessor2_0); backend picked in _sdp_flash
 
     _apply_good_scheduler(p)
     return p
@@ -108,17 +211,21 @@ def _build_pipeline_base(model_dir: str, device: str, dtype: torch.dtype) -> Sta
 
 def _build_pipeline_refiner(model_dir: str, device: str, dtype: torch.dtype) -> StableDiffusionXLImg2ImgPipeline:
     print(f"[SDXL] Building REFINER pipeline: device={device}, dtype={dtype}")
+    offload = SD_OFFLOAD and device == "cuda"
     rp = StableDiffusionXLImg2ImgPipeline.from_pretrained(
         model_dir,
         torch_dtype=dtype,
         use_safetensors=True,
         variant="fp16",
-    ).to(device)
-
-    try:
-        rp.enable_xformers_memory_efficient_attention(False)
-    except Exception:
-        pass
+    )
+    if not offload:
+        rp = rp.to(device)
+    _apply_vae_opts(rp, device)
+    _apply_channels_last(rp, device)
+    if offload:
+        # Refiner weights sit idle during BASE; offload frees that VRAM at ~no diffusion-time cost
+        rp.enable_model_cpu_offload()
+        print("[SDXL] REFINER using model CPU offload.")
 
     _apply_good_scheduler(rp)
     return rp
@@ -132,6 +239,128 @@ def _has_triton() -> bool:
         return False
 
 
+def _compile_components(p, label: str, compile_unet: bool = True):
+    """Compile UNet, VAE decode and text encoders as separate graphs (one whole-pipeline graph
+    would break on the pipeline's Python control flow). Shapes are fixed per request: dynamic=False."""
+    try:
+        if compile_unet:
+            p.unet = torch.compile(p.unet, mode=SD_COMPILE_MODE, fullgraph=True, dynamic=False)
+        else:
+            print(f"[SDXL] torch.compile skipped for quantized {label} UNet.")
+        p.vae.decode = torch.compile(p.vae.decode, mode=SD_COMPILE_MODE, fullgraph=False, dynamic=False)
+        # Text encoders: default mode, never CUDA graphs. encode_prompt holds earlier encoder
+        # outputs (TE1 hidden states, positive pooled) across later calls, which cudagraph
+        # trees would overwrite. Refiner ships only text_encoder_2.
+        for name in ("text_encoder", "text_encoder_2"):
+            enc = getattr(p, name, None)
+            if enc is not None:
+                setattr(p, name, torch.compile(enc, dynamic=False))
+        print(f"[SDXL] torch.compile ({SD_COMPILE_MODE}) enabled for {label}.")
+    except Exception as _e:
+        print(f"[SDXL] torch.compile ({label}) skipped:", _e)
+
+
+def _enable_compile_cache():
+    """Point Inductor's and Triton's on-disk caches at SD_CACHE_DIR and turn on the FX graph cache.
+    Explicit TORCHINDUCTOR_CACHE_DIR / TRITON_CACHE_DIR / TORCHINDUCTOR_FX_GRAPH_CACHE settings win."""
+    # Both cache dirs are read lazily at compile time, so setting them here still takes effect
+    os.environ.setdefault("TORCHINDUCTOR_CACHE_DIR", os.path.join(SD_CACHE_DIR, "inductor"))
+    os.environ.setdefault("TRITON_CACHE_DIR", os.path.join(SD_CACHE_DIR, "triton"))
+    try:
+        import torch._inductor.config as inductor_config
+        # Inductor reads TORCHINDUCTOR_FX_GRAPH_CACHE at import; only force the config if it's unset
+        if "TORCHINDUCTOR_FX_GRAPH_CACHE" not in os.environ:
+            inductor_config.fx_graph_cache = True
+        inductor_config.fx_graph_remote_cache = False
+        inductor_config.force_disable_caches = False
+    except Exception as e:
+        print("[SDXL] Inductor cache config skipped:", e)
+
+
+def _apply_cuda_perf_knobs():
+    """cuDNN autotune + reduced-precision matmul/conv paths. Newer knobs are hasattr-guarded."""
+    torch.backends.cudnn.benchmark = True
+
+    # TF32 on leftover fp32 matmuls/convs. torch >= 2.9 has a per-backend fp32_precision API
+    # and refuses mixing it with the legacy allow_tf32 flags, so use one or the other.
+    conv = getattr(torch.backends.cudnn, "conv", None)
+    if conv is not None and hasattr(conv, "fp32_precision"):
+        torch.backends.cuda.matmul.fp32_precision = "tf32"
+        conv.fp32_precision = "tf32"
+    else:
+        torch.set_float32_matmul_precision("high")
+        torch.backends.cuda.matmul.allow_tf32 = True
+        torch.backends.cudnn.allow_tf32 = True
+
+    matmul = torch.backends.cuda.matmul
+    if hasattr(matmul, "allow_bf16_reduced_precision_reduction"):
+        matmul.allow_bf16_reduced_precision_reduction = True
+    if hasattr(matmul, "allow_fp16_accumulation"):
+        matmul.allow_fp16_accumulation = True
+
+    # Each new resolution is a new graph; don't fall back to eager after the default 8
+    try:
+        import torch._dynamo
+        torch._dynamo.config.cache_size_limit = 128
+    except Exception as e:
+        print("[SDXL] dynamo cache_size_limit skipped:", e)
+
+
+def _warmup_shapes() -> List[Tuple[int, int]]:
+    """Parsed WARMUP_SHAPES, keeping only sizes /txt2img will actually accept."""
+    shapes = []
+    for item in WARMUP_SHAPES.split(","):
+        try:
+            w, h = (int(v) for v in item.lower().strip().split("x"))
+        except ValueError:
+            print(f"[SDXL] Ignoring bad warmup shape: {item!r}")
+            continue
+        if w > MAX_W or h > MAX_H:
+            print(f"[SDXL] Warmup {w}x{h} skipped: exceeds {MAX_W}x{MAX_H}")
+            continue
+        shapes.append((w, h))
+    return shapes
+
+
+def _warmup_all():
+    # Compiled graphs are specialized (dynamic=False) on batch size too, so every batch size
+    # _batch_worker can produce must be warmed, or its first arrival recompiles mid-traffic.
+    # Eager mode only pays a cuDNN algo search per new shape: batch 1 is enough there.
+    compiled = ENABLE_TORCH_COMPILE and _has_triton()
+    batches = range(1, MAX_BATCH + 1) if compiled else (1,)
+    for w, h in _warmup_shapes():
+        for b in batches:
+            _warmup(w, h, batch=b)
+
+
+def _warmup(width: int = 1024, height: int = 1024, batch: int = 1, steps: int = 2):
+    """Drive every compiled component once with real-request shapes (CFG on, full decode).
+    Blocking; run on the GPU worker thread so the recorded CUDA graphs are reused."""
+    try:
+        t0 = time.time()
+        common = dict(
+            prompt="warmup",
+            num_images_per_prompt=batch,
+            width=width,
+            height=height,
+            num_inference_steps=steps,
+            guidance_scale=DEFAULT_GUIDANCE,
+        )
+        with _sdp_flash():
+            # BASE UNet + BASE VAE decode (no-refiner path)
+            _images(pipe, pipe(**common, output_type=_final_output_type(pipe)))
+            lat = pipe(**common, denoising_end=0.5, output_type="latent").images if refiner is not None else None
+        if refiner is not None:
+            with _sdp_flash():
+                out = refiner(prompt="warmup", num_images_per_prompt=batch, image=lat, num_inference_steps=steps,
+                              guidance_scale=DEFAULT_GUIDANCE, denoising_start=0.5,
+                              output_type=_final_output_type(refiner))
+            _images(refiner, out)
+        print(f"[SDXL] Warmup {width}x{height} x{batch} done in {time.time() - t0:.1f}s")
+    except Exception as e:
+        print(f"[SDXL] Warmup {width}x{height} x{batch} skipped:", e)
+
+
 async def _load_model_bg():
     """Load the SDXL pipelines in the background on server startup."""
     global pipe, refiner, _model_error, _current_device, _current_dtype, _has_refiner
@@ -159,8 +388,12 @@ async def _load_model_bg():
 
         # Perf toggles
         if device == "cuda":
-            torch.backends.cudnn.benchmark = True
-            torch.set_float32_matmul_precision("high")  # TF32 on leftover fp32
+            _apply_cuda_perf_knobs()
+            # Growable segments instead of fixed blocks: less fragmentation as request shapes vary
+            try:
+                torch.cuda.memory._set_allocator_settings("expandable_segments:True")
+            except Exception as e:
+                print("[SDXL] expandable_segments skipped:", e)
 
         # Base pipeline
         pipe = _build_pipeline_base(SDXL_DIR, device, dtype)
@@ -184,23 +417,23 @@ async def _load_model_bg():
 
         # Optional: compile (requires Triton)
         if device == "cuda" and ENABLE_TORCH_COMPILE and _has_triton():
-            try:
-                pipe.unet = torch.compile(pipe.unet, mode="max-autotune")
-                print("[SDXL] torch.compile enabled for BASE.")
-            except Exception as _e:
-                print("[SDXL] torch.compile (BASE) skipped:", _e)
-            if refiner is not None:
-                try:
-                    refiner.unet = torch.compile(refiner.unet, mode="max-autotune")
-                    print("[SDXL] torch.compile enabled for REFINER.")
-                except Exception as _e:
-                    print("[SDXL] torch.compile (REFINER) skipped:", _e)
+            _enable_compile_cache()
+            _compile_components(pipe, "BASE", compile_unet=not getattr(pipe.unet, "is_quantized", False))
+            if refiner is not None and SD_OFFLOAD:
+                print("[SDXL] torch.compile skipped for REFINER (CPU offload hooks break full graphs).")
+            elif refiner is not None:
+                _compile_components(refiner, "REFINER")
         elif ENABLE_TORCH_COMPILE and not _has_triton():
             print("[SDXL] torch.compile disabled: Triton not installed.")
 
         _model_error = None
         _model_ready.set()
         print(f"[SDXL] Models loaded in {time.time() - t0:.1f}s on {device} | refiner={_has_refiner}")
+
+        # Requests arriving meanwhile simply queue behind the warmup on the GPU
+        if device == "cuda" and ENABLE_WARMUP:
+            async with _gpu_sem:
+                await asyncio.get_running_loop().run_in_executor(_gpu_executor, _warmup_all)
     except Exception as e:
         _model_error = str(e)
         print("[SDXL] Failed to load model(s):", _model_error)
@@ -210,6 +443,7 @@ async def _load_model_bg():
 @app.on_event("startup")
 async def _startup():
     asyncio.create_task(_load_model_bg())
+    asyncio.create_task(_batch_worker())
 
 
 class Txt2ImgReq(BaseModel):
@@ -230,6 +464,8 @@ class Txt2ImgReq(BaseModel):
         default=0.8, ge=0.5, le=0.98,
         description="Fraction of denoising done by BASE before handing off to REFINER"
     )
+    format: Literal["png", "jpeg"] = Field(default="png", description="Encoding of image_base64")
+    quality: int = Field(default=90, ge=1, le=100, description="JPEG quality (ignored for PNG)")
 
 
 @app.get("/health")
@@ -258,110 +494,255 @@ def status():
     }
 
 
+@lru_cache(maxsize=1)
+def _sdpa_kernel_args():
+    """(sdpa_kernel, backends, kwargs), or None on torch without torch.nn.attention."""
+    try:
+        from torch.nn.attention import SDPBackend, sdpa_kernel
+    except ImportError:
+        return None
+    names = ("CUDNN_ATTENTION", "FLASH_ATTENTION", "EFFICIENT_ATTENTION")
+    backends = [getattr(SDPBackend, n) for n in names if hasattr(SDPBackend, n)]
+    # The list is only an allowed set unless set_priority=True (torch >= 2.6) makes it an order
+    kwargs = {"set_priority": True} if "set_priority" in inspect.signature(sdpa_kernel).parameters else {}
+    return sdpa_kernel, backends, kwargs
+
+
 @contextmanager
 def _sdp_flash():
-    # Force Flash/MemEff SDPA kernels where possible
-    with torch.backends.cuda.sdp_kernel(enable_flash=True, enable_mem_efficient=True, enable_math=False):
+    # cuDNN/Flash/MemEff SDPA only. Where torch supports priorities, cuDNN goes first (fastest on
+    # Blackwell, and Flash is unavailable on Windows builds); older torch keeps its own order.
+    args = _sdpa_kernel_args()
+    if args is None:
+        with torch.backends.cuda.sdp_kernel(enable_flash=True, enable_mem_efficient=True, enable_math=False):
+            yield
+        return
+
+    sdpa_kernel, backends, kwargs = args
+    with sdpa_kernel(backends, **kwargs):
         yield
 
 
-@app.post("/txt2img")
-def txt2img(p: Txt2ImgReq):
-    global pipe, refiner, _current_device, _current_dtype, _has_refiner
+def _fp16_vae(p) -> bool:
+    """fp16-fix VAE under bf16 UNets: diffusers won't cast the latents, so we decode ourselves."""
+    return _current_dtype == "bfloat16" and p.vae.dtype == torch.float16
 
-    if _model_error:
-        raise HTTPException(500, f"Model failed to load: {_model_error}")
-    if not _model_ready.is_set():
-        raise HTTPException(503, "Model is still loading; try again shortly.")
 
-    if p.width > MAX_W or p.height > MAX_H:
-        raise HTTPException(400, f"Max size is {MAX_W}x{MAX_H}")
-    if p.steps > MAX_STEPS:
-        raise HTTPException(400, f"Max steps is {MAX_STEPS}")
-    if not (0.0 < p.refiner_fraction < 1.0):
-        raise HTTPException(400, "refiner_fraction must be in (0,1)")
+def _final_output_type(p) -> str:
+    return "latent" if _fp16_vae(p) else "pil"
+
+
+def _decode_latents(p, latents) -> List[Image.Image]:
+    """VAE decode in the VAE's own dtype, outside autocast (mirrors the SDXL pipelines' decode)."""
+    vae = p.vae
+    latents = latents.to(vae.dtype)
+    mean = getattr(vae.config, "latents_mean", None)
+    std = getattr(vae.config, "latents_std", None)
+    if mean is not None and std is not None:
+        mean = torch.tensor(mean).view(1, 4, 1, 1).to(latents.device, latents.dtype)
+        std = torch.tensor(std).view(1, 4, 1, 1).to(latents.device, latents.dtype)
+        latents = latents * std / vae.config.scaling_factor + mean
+    else:
+        latents = latents / vae.config.scaling_factor
+    with torch.no_grad(), _sdp_flash():
+        image = vae.decode(latents, return_dict=False)[0]
+    if getattr(p, "watermark", None) is not None:
+        image = p.watermark.apply_watermark(image)
+    return p.image_processor.postprocess(image, output_type="pil")
+
+
+def _images(p, out) -> List[Image.Image]:
+    """PIL images from a call made with output_type=_final_output_type(p)."""
+    return _decode_latents(p, out.images) if _fp16_vae(p) else out.images
+
+
+@lru_cache(maxsize=64)
+def _encode(which: str, prompt: str, neg: Optional[str], dev: str) -> dict:
+    """Text-encoder outputs for a prompt pair, cached per pipeline ("base"/"refiner") and device."""
+    p = pipe if which == "base" else refiner
+    assert p is not None
+    with torch.no_grad():
+        pe, npe, ppe, nppe = p.encode_prompt(
+            prompt,
+            device=dev,
+            num_images_per_prompt=1,
+            do_classifier_free_guidance=True,
+            negative_prompt=neg,
+        )
+    return dict(
+        prompt_embeds=pe.detach(),
+        negative_prompt_embeds=npe.detach(),
+        pooled_prompt_embeds=ppe.detach(),
+        negative_pooled_prompt_embeds=nppe.detach(),
+    )
+
+
+def _encode_image_b64(img: Image.Image, fmt: str, quality: int) -> str:
+    buf = io.BytesIO()
+    if fmt == "jpeg":
+        img.save(buf, "JPEG", quality=quality)
+    else:
+        # compress_level=1: much cheaper deflate than the default 6 for a slightly larger file
+        img.save(buf, "PNG", optimize=False, compress_level=1)
+    # getbuffer() hands base64 a view of the buffer instead of a getvalue() copy
+    return base64.b64encode(buf.getbuffer()).decode("ascii")
+
+
+def _schedule(scheduler, steps: int):
+    """(timesteps, cutoff fn) for a fresh copy of `scheduler` set to `steps`; the live one stays untouched."""
+    s = type(scheduler).from_config(scheduler.config)
+    s.set_timesteps(steps)
+    T = s.config.num_train_timesteps
+    # Same cut as diffusers' denoising_end / denoising_start
+    return s.timesteps, lambda fraction: int(round(T - fraction * T))
+
+
+def _refiner_steps(ref_sched, steps: int, fraction: float) -> int:
+    """Denoising steps REFINER really runs with denoising_start=fraction (Karras sigmas put
+    far more than steps*(1-fraction) of them below the cut)."""
+    ts, cutoff = _schedule(ref_sched, steps)
+    return int((ts < cutoff(fraction)).sum())
+
+
+def _split_steps(base_sched, ref_sched, steps: int, fraction: float) -> Tuple[int, int]:
+    """(BASE, REFINER) denoising steps really run for a denoising_end/denoising_start split,
+    counted on each pipeline's own schedule (not steps*fraction: Karras sigmas skew the cut)."""
+    ts, cutoff = _schedule(base_sched, steps)
+    base_steps = int((ts >= cutoff(fraction)).sum())
+    return base_steps, _refiner_steps(ref_sched, steps, fraction)
+
+
+_REFINER_SEED_SALT = 0x9E3779B97F4A7C15  # 64-bit golden ratio: decorrelates REFINER from BASE seed
+
+
+def _make_generators(reqs: List[Txt2ImgReq], dev: str, salt: int = 0) -> List[torch.Generator]:
+    gens = []
+    for r in reqs:
+        gen = torch.Generator(device=dev)
+        if r.seed is not None:
+            gen = gen.manual_seed((int(r.seed) ^ salt) & 0xFFFFFFFFFFFFFFFF)
+        gens.append(gen)
+    return gens
+
+
+def _can_batch(a: Txt2ImgReq, b: Txt2ImgReq) -> bool:
+    """Requests can share one UNet forward when everything but prompt/seed matches."""
+    return (
+        a.width == b.width
+        and a.height == b.height
+        and a.steps == b.steps
+        and a.guidance == b.guidance
+        and a.guidance_rescale == b.guidance_rescale
+        and a.use_refiner == b.use_refiner
+        and a.refiner_fraction == b.refiner_fraction
+    )
+
+
+def _stack_embeds(which: str, reqs: List[Txt2ImgReq], dev: str) -> dict:
+    """Per-prompt cached embeddings concatenated along the batch dim."""
+    parts = [_encode(which, r.prompt, r.negative_prompt, dev) for r in reqs]
+    return {k: torch.cat([e[k] for e in parts]) for k in parts[0]}
+
 
+def _generate(reqs: List[Txt2ImgReq]) -> Tuple[List[Image.Image], bool]:
+    """Run BASE (+ optional REFINER) for a batch of compatible requests (see _can_batch).
+    Blocking; call only from the GPU worker thread."""
+    global pipe, refiner, _current_device, _current_dtype, _has_refiner
+
+    p = reqs[0]  # shared settings
     use_cuda = torch.cuda.is_available() and (_current_device == "cuda")
     dev = "cuda" if use_cuda else "cpu"
 
-    gen = torch.Generator(device=dev)
-    if p.seed is not None:
-        gen = gen.manual_seed(int(p.seed))
+    # One generator per sample and per stage: each request keeps its own seed inside the batch,
+    # and REFINER noise doesn't depend on how much state BASE consumed
+    gens_base = _make_generators(reqs, dev)
+    gens_ref = _make_generators(reqs, dev, salt=_REFINER_SEED_SALT)
 
     # ---- BASE kwargs (common) ----
     base_kwargs = dict(
-        prompt=p.prompt,
-        negative_prompt=p.negative_prompt,
         width=p.width,
         height=p.height,
         num_inference_steps=p.steps,
         guidance_scale=p.guidance,
         guidance_rescale=p.guidance_rescale,
-        generator=gen,
+        generator=gens_base,
     )
 
     use_ref = _has_refiner and p.use_refiner
+    if use_ref and _refiner_steps(refiner.scheduler, p.steps, p.refiner_fraction) < 2:
+        # A 0-1 step refine can't add detail but still costs a REFINER call + VAE decode
+        use_ref = False
+        print("[SDXL] refiner bypassed: effective refiner steps < 2")
 
     # If using refiner: BASE returns LATENTS, then REFINER continues from that point.
+    # denoising_end/denoising_start cut ONE p.steps schedule at timestep T*(1-fraction): BASE
+    # runs the timesteps above the cut, REFINER those below (see _split_steps; with Karras
+    # sigmas that is not steps*fraction). Nothing is denoised twice, and the latents need no
+    # re-noising as in a plain img2img hand-off.
     if use_ref:
         base_kwargs["denoising_end"] = p.refiner_fraction
         base_kwargs["output_type"] = "latent"
 
         ref_kwargs = dict(
-            prompt=p.prompt,
-            negative_prompt=p.negative_prompt,
             image=None,  # will be latents tensor from base
             num_inference_steps=p.steps,
             guidance_scale=p.guidance,
             guidance_rescale=p.guidance_rescale,
             denoising_start=p.refiner_fraction,
-            generator=gen,
+            generator=gens_ref,
+            output_type=_final_output_type(refiner),
         )
     else:
-        ref_kwargs = None  # base will directly produce PIL
+        base_kwargs["output_type"] = _final_output_type(pipe)
+        ref_kwargs = None  # base will directly produce the final image
 
-    t0 = time.time()
+    def attach_embeds(device: str):
+        # Cached prompt embeddings replace prompt/negative_prompt (skips both text encoders on hits).
+        # REFINER's are fetched in run_*_refine, once BASE is done: with SD_OFFLOAD a cache miss
+        # pulls its text_encoder_2 onto the GPU, and it must not sit there through the BASE denoise.
+        base_kwargs.update(_stack_embeds("base", reqs, device))
 
+    # No autocast: CUDA weights are already bf16 (autocast would only add per-op dtype checks
+    # to the hot loop), and an fp16-fix VAE is decoded separately by _decode_latents.
     def run_cuda_base(**kwargs):
-        with torch.autocast(device_type="cuda", dtype=torch.bfloat16):
-            with _sdp_flash():
-                return pipe(**kwargs)
+        with _sdp_flash():
+            return pipe(**kwargs)
 
     def run_cuda_refine(latents):
         assert refiner is not None
-        with torch.autocast(device_type="cuda", dtype=torch.bfloat16):
-            with _sdp_flash():
-                ref_kwargs["image"] = latents
-                return refiner(**ref_kwargs)
+        ref_kwargs.update(_stack_embeds("refiner", reqs, "cuda"))
+        with _sdp_flash():
+            ref_kwargs["image"] = latents
+            return refiner(**ref_kwargs)
 
     def run_cpu_base(**kwargs):
         return pipe(**kwargs)
 
     def run_cpu_refine(latents):
         assert refiner is not None
+        ref_kwargs.update(_stack_embeds("refiner", reqs, "cpu"))
         ref_kwargs["image"] = latents
         return refiner(**ref_kwargs)
 
     try:
+        attach_embeds(dev)
         if use_cuda:
             base_out = run_cuda_base(**base_kwargs)
         else:
             base_out = run_cpu_base(**base_kwargs)
 
         if use_ref:
-            # IMPORTANT: pass LATENTS to refiner
-            latents = base_out.images[0]
+            # IMPORTANT: pass LATENTS (whole batch) to refiner
+            latents = base_out.images
+            if use_cuda:
+                # Hand BASE's freed activations/buffers back before the REFINER UNet runs
+                del base_out
+                torch.cuda.empty_cache()
             refined = run_cuda_refine(latents) if use_cuda else run_cpu_refine(latents)
-            final_img: Image.Image = refined.images[0]
+            images: List[Image.Image] = _images(refiner, refined)
         else:
-            # Not using refiner → decode to image with a second call
-            # (same settings but let it finish & output PIL)
-            full_kwargs = dict(base_kwargs)
-            full_kwargs.pop("denoising_end", None)
-            full_kwargs.pop("output_type", None)
-            full_kwargs["output_type"] = "pil"
-            full = run_cuda_base(**full_kwargs) if use_cuda else run_cpu_base(**full_kwargs)
-            final_img: Image.Image = full.images[0]
+            # Not using refiner → BASE ran the full schedule itself
+            images: List[Image.Image] = _images(pipe, base_out)
 
     except RuntimeError as e:
         msg = str(e).lower()
@@ -384,35 +765,112 @@ def txt2img(p: Txt2ImgReq):
                     _has_refiner = False
 
             _current_device, _current_dtype = "cpu", "float32"
+            _encode.cache_clear()
+            # Generators are device-bound; re-create them on CPU with the same seeds
+            gens_base[:] = _make_generators(reqs, "cpu")
+            gens_ref[:] = _make_generators(reqs, "cpu", salt=_REFINER_SEED_SALT)
+            attach_embeds("cpu")
+
+            if use_ref and refiner is None:
+                # Refiner lost in the rebuild → let BASE finish the schedule itself
+                use_ref = False
+                base_kwargs.pop("denoising_end", None)
+            # Rebuilt pipelines have no fp16-fix VAE (CUDA only): decode inside the pipeline again
+            if use_ref:
+                ref_kwargs["output_type"] = _final_output_type(refiner)
+            else:
+                base_kwargs["output_type"] = _final_output_type(pipe)
 
             base_out = run_cpu_base(**base_kwargs)
-            if use_ref and refiner is not None:
-                latents = base_out.images[0]
+            if use_ref:
+                latents = base_out.images
                 refined = run_cpu_refine(latents)
-                final_img = refined.images[0]
+                images = _images(refiner, refined)
             else:
-                full_kwargs = dict(base_kwargs)
-                full_kwargs.pop("denoising_end", None)
-                full_kwargs.pop("output_type", None)
-                full_kwargs["output_type"] = "pil"
-                full = run_cpu_base(**full_kwargs)
-                final_img = full.images[0]
+                images = _images(pipe, base_out)
         else:
             raise
 
-    # ---- Encode PNG to base64 ----
-    buf = io.BytesIO()
-    final_img.save(buf, "PNG")
-    b64 = base64.b64encode(buf.getvalue()).decode("utf-8")
+    return images, use_ref
+
+
+async def _batch_worker():
+    """Drain the job queue, coalescing up to MAX_BATCH compatible requests per GPU call."""
+    loop = asyncio.get_running_loop()
+    carry = None
+    while True:
+        first = carry if carry is not None else await _job_queue.get()
+        carry = None
+        batch = [first]
+        # Only take what is already waiting: batching never delays a lone request
+        while len(batch) < MAX_BATCH and not _job_queue.empty():
+            nxt = _job_queue.get_nowait()
+            if _can_batch(first[0], nxt[0]):
+                batch.append(nxt)
+            else:
+                carry = nxt  # keeps FIFO order; it leads the next batch
+                break
+
+        reqs = [r for r, _ in batch]
+        try:
+            async with _gpu_sem:
+                images, use_ref = await loop.run_in_executor(_gpu_executor, _generate, reqs)
+            if len(batch) > 1:
+                print(f"[SDXL] Batched {len(batch)} requests into one generation.")
+            for (_, fut), img in zip(batch, images):
+                if not fut.done():
+                    fut.set_result((img, use_ref))
+        except Exception as e:
+            for _, fut in batch:
+                if not fut.done():
+                    fut.set_exception(e)
+
+
+@app.post("/txt2img")
+async def txt2img(p: Txt2ImgReq):
+    global _pending
+
+    if _model_error:
+        raise HTTPException(500, f"Model failed to load: {_model_error}")
+    if not _model_ready.is_set():
+        raise HTTPException(503, "Model is still loading; try again shortly.")
+
+    if p.width > MAX_W or p.height > MAX_H:
+        raise HTTPException(400, f"Max size is {MAX_W}x{MAX_H}")
+    if p.steps > MAX_STEPS:
+        raise HTTPException(400, f"Max steps is {MAX_STEPS}")
+    if not (0.0 < p.refiner_fraction < 1.0):
+        raise HTTPException(400, "refiner_fraction must be in (0,1)")
+
+    if _pending >= MAX_QUEUE:
+        raise HTTPException(429, f"Generation queue is full ({_pending} pending); try again shortly.")
+
+    # Queued for _batch_worker: GPU work stays serialized, compatible requests share a batch
+    _pending += 1
+    try:
+        t0 = time.time()
+        fut = asyncio.get_running_loop().create_future()
+        await _job_queue.put((p, fut))
+        final_img, use_ref = await fut
+    finally:
+        _pending -= 1
+
+    # ---- Encode PNG/JPEG to base64 ----
+    # Off the event loop and off the GPU thread: overlaps with the next batch's generation
+    b64 = await asyncio.to_thread(_encode_image_b64, final_img, p.format, p.quality)
 
     elapsed = time.time() - t0
+    steps_info = f"{p.steps}"
+    if use_ref and pipe is not None and refiner is not None:
+        base_steps, ref_steps = _split_steps(pipe.scheduler, refiner.scheduler, p.steps, p.refiner_fraction)
+        steps_info += f"(base {base_steps}+ref {ref_steps})"
     print(
         f"[SDXL] Generated in {elapsed:.1f}s | "
-        f"{p.width}x{p.height} | steps={p.steps} | cfg={p.guidance} | rescale={p.guidance_rescale} | seed={p.seed} | "
+        f"{p.width}x{p.height} | steps={steps_info} | cfg={p.guidance} | rescale={p.guidance_rescale} | seed={p.seed} | "
         f"refiner={'on' if use_ref else 'off'}({p.refiner_fraction if use_ref else '-'}) | "
         f"dev={_current_device}/{_current_dtype} | prompt='{p.prompt[:80]}'"
     )
-    return {"image_base64": b64}
+    return {"image_base64": b64, "format": p.format}
 
 
 if __name__ == "__main__":